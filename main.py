@@ -1,8 +1,11 @@
 import os
-import json
+import re
+import orjson
 import asyncio
 import logging
 import websockets
+from websockets.asyncio.client import ClientConnection
+from websockets.protocol import State
 import google.generativeai as genai
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request
 from fastapi.middleware.cors import CORSMiddleware
@@ -11,8 +14,16 @@ from fastapi.templating import Jinja2Templates
 from fastapi.responses import HTMLResponse
 from dotenv import load_dotenv
 import aiohttp
+from cachetools import LRUCache, TTLCache
 import random
-from typing import Optional, Dict
+import struct
+import pybase64
+import uuid
+from collections import deque
+from datetime import datetime
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterable, AsyncIterator, Optional, Dict
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("ai_voice_agent")
@@ -22,7 +33,38 @@ ENV_ASSEMBLYAI_KEY = os.getenv("ASSEMBLYAI_API_KEY") or ""
 ENV_GEMINI_API_KEY = os.getenv("GEMINI_API_KEY") or ""
 ENV_MURF_API_KEY = os.getenv("MURF_API_KEY") or ""
 
-app = FastAPI()
+if ENV_GEMINI_API_KEY:
+    genai.configure(api_key=ENV_GEMINI_API_KEY)
+
+HTTP_SESSION: Optional[aiohttp.ClientSession] = None
+SKILL_HTTP_TIMEOUT = aiohttp.ClientTimeout(total=5)
+# Every live Gemini stream holds a worker thread while it waits for the next
+# part, so the default executor (min(32, cpus + 4)) is too small under load.
+BLOCKING_IO_THREADS = 200
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global HTTP_SESSION
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=BLOCKING_IO_THREADS))
+    # One pooled session for all skill lookups keeps DNS and TLS warm.
+    HTTP_SESSION = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=100, ttl_dns_cache=300, keepalive_timeout=60)
+    )
+    history_task = asyncio.create_task(_history_writer())
+    try:
+        yield
+    finally:
+        await history_queue.put(None)
+        try:
+            await history_task
+        except Exception:
+            logger.exception("History writer failed")
+        await HTTP_SESSION.close()
+        HTTP_SESSION = None
+
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"]
@@ -41,25 +83,96 @@ async def health():
     return {"ok": True}
 
 
-HISTORY_FILE = "chat_history.json"
-history_lock = asyncio.Lock()
+# History is an append-only NDJSON log: one {"session", "role", "text"} record
+# per line. The old single-document JSON file is still read on startup.
+HISTORY_FILE = "chat_history.ndjson"
+LEGACY_HISTORY_FILE = "chat_history.json"
+HISTORY_FLUSH_INTERVAL = 0.25
+HISTORY_FLUSH_BATCH = 50
+# In-memory history is only used to drop repeated turns, so keep it small:
+# the last few turns of recently active sessions. The NDJSON log keeps everything.
+HISTORY_TURNS_KEPT = 20
+HISTORY_MAX_SESSIONS = 10_000
+HISTORY_SESSION_TTL = 3600
+history_queue: "asyncio.Queue[Optional[str]]" = asyncio.Queue()
 
 
-def _load_histories():
+def _load_histories() -> TTLCache:
+    histories = TTLCache(maxsize=HISTORY_MAX_SESSIONS, ttl=HISTORY_SESSION_TTL)
+    if os.path.exists(LEGACY_HISTORY_FILE):
+        try:
+            with open(LEGACY_HISTORY_FILE, "rb") as f:
+                for sid, turns in orjson.loads(f.read()).items():
+                    histories[sid] = deque(turns, maxlen=HISTORY_TURNS_KEPT)
+        except Exception as e:
+            logger.warning("Could not load history file (%s). Error: %s", LEGACY_HISTORY_FILE, e)
     if os.path.exists(HISTORY_FILE):
         try:
-            with open(HISTORY_FILE, "r", encoding="utf-8") as f:
-                return json.load(f)
+            with open(HISTORY_FILE, "rb") as f:
+                for line in f:
+                    try:
+                        rec = orjson.loads(line)
+                    except ValueError:
+                        continue  # blank or torn line from an interrupted write
+                    turns = histories.get(rec["session"])
+                    if turns is None:
+                        turns = histories[rec["session"]] = deque(maxlen=HISTORY_TURNS_KEPT)
+                    turns.append({"role": rec["role"], "text": rec["text"]})
         except Exception as e:
-            logger.warning("Could not load history file (%s). Starting empty. Error: %s", HISTORY_FILE, e)
-    return {}
+            logger.warning("Could not load history file (%s). Error: %s", HISTORY_FILE, e)
+    return histories
+
+
+def _append_history_lines(f, lines):
+    f.write("".join(lines))
+    f.flush()
+
+
+async def _history_writer():
+    """Drain history_queue into HISTORY_FILE in small batches until a None arrives."""
+    try:
+        f = open(HISTORY_FILE, "a", encoding="utf-8")
+    except Exception:
+        logger.exception("Could not open history file (%s); chat history will not be saved", HISTORY_FILE)
+        # Keep consuming so queued turns don't pile up in memory.
+        while await history_queue.get() is not None:
+            pass
+        return
+    with f:
+        done = False
+        while not done:
+            line = await history_queue.get()
+            if line is None:
+                break
+            # Give the rest of the turn a moment to queue up, unless a full
+            # batch is already waiting, then write it all at once.
+            if history_queue.qsize() < HISTORY_FLUSH_BATCH - 1:
+                await asyncio.sleep(HISTORY_FLUSH_INTERVAL)
+            lines = [line]
+            while len(lines) < HISTORY_FLUSH_BATCH and not history_queue.empty():
+                line = history_queue.get_nowait()
+                if line is None:
+                    done = True
+                    break
+                lines.append(line)
+            try:
+                await asyncio.to_thread(_append_history_lines, f, lines)
+            except Exception:
+                logger.exception("Failed to write history file")
 
 
 session_histories = _load_histories()
 session_personas: Dict[str, str] = {}
 session_skills: Dict[str, str] = {}
-session_inflight: Dict[str, bool] = {}
-session_last_text: Dict[str, str] = {}
+# Hash of the last normalized user turn, used to drop AssemblyAI repeats.
+session_last_text: Dict[str, Optional[int]] = {}
+
+
+def _drop_session_state(session_id: str):
+    """Forget per-connection state; history stays until its TTL expires."""
+    for d in (session_personas, session_skills, session_last_text):
+        d.pop(session_id, None)
+
 
 # Murf voice is fixed
 FIXED_MURF_VOICE = "en-IN-arohi"
@@ -72,186 +185,444 @@ PERSONA_PROMPTS = {
     "professor": "You are a wise professor. Explain things clearly, formally, and with patience.",
     "buddy": "You are a casual supportive buddy. Be warm, cheerful, and encouraging.",
 }
+# Full Gemini system instructions, built once rather than on every turn.
+PERSONA_SYSTEM_PROMPTS = {name: f"{prompt}\nRespond in character." for name, prompt in PERSONA_PROMPTS.items()}
+
+_WS = re.compile(r"\s+")
+
+
+def _normalize_text(text: str) -> str:
+    return _WS.sub(" ", text).strip().casefold()
 
 
 async def save_turn(session_id: str, role: str, text: str):
     text = text.strip()
     if not text:
         return
-    async with history_lock:
-        if session_id not in session_histories:
-            session_histories[session_id] = []
-        if session_histories[session_id]:
-            last = session_histories[session_id][-1]
-            if last.get("role") == role and last.get("text", "").strip() == text:
-                return
-        session_histories[session_id].append({"role": role, "text": text})
-        try:
-            with open(HISTORY_FILE, "w", encoding="utf-8") as f:
-                json.dump(session_histories, f, indent=2, ensure_ascii=False)
-        except Exception:
-            logger.exception("Failed to write history file")
+    # No await between the dedup check and the append, so this is atomic with
+    # respect to other sessions' turns; the file write happens in _history_writer.
+    turns = session_histories.get(session_id)
+    if turns is None:
+        turns = deque(maxlen=HISTORY_TURNS_KEPT)
+    if turns:
+        last = turns[-1]
+        if last.get("role") == role and last.get("text", "").strip() == text:
+            return
+    turns.append({"role": role, "text": text})
+    # Re-inserting restarts the session's TTL.
+    session_histories[session_id] = turns
+    record = {"session": session_id, "role": role, "text": text}
+    history_queue.put_nowait(orjson.dumps(record).decode() + "\n")
+
+
+# Audio goes to the browser as binary frames instead of base64 inside JSON:
+# a 16-byte big-endian header (message type, audio format, chunk index,
+# sample rate, payload length) followed by the raw audio bytes.
+TTS_CHUNK_HEADER = struct.Struct(">HHIII")
+MSG_TTS_CHUNK = 1
+FORMAT_WAV = 1
+
+
+async def safe_send_bytes(ws: WebSocket, payload: bytes):
+    try:
+        await ws.send_bytes(payload)
+    except Exception:
+        pass
 
 
 async def safe_send_json(ws: WebSocket, payload: dict):
+    # Sent as a text frame: the browser client only parses string messages.
     try:
-        await ws.send_json(payload)
+        await ws.send_text(orjson.dumps(payload).decode())
     except Exception:
         pass
 
 
 # ========= Skills =========
-async def handle_skill(user_text: str, forced_skill: Optional[str] = None) -> Optional[str]:
-    skill = forced_skill or ""
-    if (skill == "weather") or ("weather" in user_text.lower()):
-        async with aiohttp.ClientSession() as session:
-            try:
-                url = "https://api.open-meteo.com/v1/forecast?latitude=28.6&longitude=77.2&current_weather=true"
-                async with session.get(url) as resp:
+async def _weather_skill(user_text: str) -> Optional[str]:
+    try:
+        url = "https://api.open-meteo.com/v1/forecast?latitude=28.6&longitude=77.2&current_weather=true"
+        async with HTTP_SESSION.get(url, timeout=SKILL_HTTP_TIMEOUT) as resp:
+            data = await resp.json()
+            weather = data.get("current_weather", {})
+            temp = weather.get("temperature")
+            wind = weather.get("windspeed")
+            if temp is not None:
+                return f"The current weather in Delhi is {temp}°C with winds at {wind} km/h."
+    except:
+        return "Sorry, I couldn't fetch the weather right now."
+    return None
+
+
+async def _news_skill(user_text: str) -> Optional[str]:
+    headlines = [
+        "AI is transforming industries worldwide.",
+        "SpaceX successfully launched another batch of satellites.",
+        "Scientists discover a new exoplanet in the habitable zone.",
+    ]
+    return "Here are the latest headlines: " + " ".join(headlines)
+
+
+async def _joke_skill(user_text: str) -> Optional[str]:
+    jokes = [
+        "Why did the computer go to the doctor? Because it caught a virus!",
+        "Why don’t robots ever get lost? Because they follow their GPS—Giggle Positioning System.",
+        "I told my AI to tell me a joke, but it just said 'I'm sorry, I don’t have a sense of humor… yet.'",
+    ]
+    return random.choice(jokes)
+
+
+async def _quote_skill(user_text: str) -> Optional[str]:
+    quotes = [
+        "The best way to predict the future is to invent it. — Alan Kay",
+        "Do what you can, with what you have, where you are. — Theodore Roosevelt",
+        "In the middle of every difficulty lies opportunity. — Albert Einstein",
+    ]
+    return random.choice(quotes)
+
+
+async def _dictionary_skill(user_text: str) -> Optional[str]:
+    words = user_text.split()
+    if len(words) > 1:
+        term = words[-1]
+        try:
+            url = f"https://api.dictionaryapi.dev/api/v2/entries/en/{term}"
+            async with HTTP_SESSION.get(url, timeout=SKILL_HTTP_TIMEOUT) as resp:
+                if resp.status == 200:
                     data = await resp.json()
-                    weather = data.get("current_weather", {})
-                    temp = weather.get("temperature")
-                    wind = weather.get("windspeed")
-                    if temp is not None:
-                        return f"The current weather in Delhi is {temp}°C with winds at {wind} km/h."
-            except:
-                return "Sorry, I couldn't fetch the weather right now."
-    if (skill == "news") or ("news" in user_text.lower()):
-        headlines = [
-            "AI is transforming industries worldwide.",
-            "SpaceX successfully launched another batch of satellites.",
-            "Scientists discover a new exoplanet in the habitable zone.",
-        ]
-        return "Here are the latest headlines: " + " ".join(headlines)
-    if (skill in ("joke", "jokes")) or ("joke" in user_text.lower()):
-        jokes = [
-            "Why did the computer go to the doctor? Because it caught a virus!",
-            "Why don’t robots ever get lost? Because they follow their GPS—Giggle Positioning System.",
-            "I told my AI to tell me a joke, but it just said 'I'm sorry, I don’t have a sense of humor… yet.'",
-        ]
-        return random.choice(jokes)
-    if (skill == "quote") or ("quote" in user_text.lower()):
-        quotes = [
-            "The best way to predict the future is to invent it. — Alan Kay",
-            "Do what you can, with what you have, where you are. — Theodore Roosevelt",
-            "In the middle of every difficulty lies opportunity. — Albert Einstein",
-        ]
-        return random.choice(quotes)
-    if (skill == "dictionary") or ("define" in user_text.lower()):
-        words = user_text.split()
-        if len(words) > 1:
-            term = words[-1]
-            try:
-                async with aiohttp.ClientSession() as session:
-                    url = f"https://api.dictionaryapi.dev/api/v2/entries/en/{term}"
-                    async with session.get(url) as resp:
-                        if resp.status == 200:
-                            data = await resp.json()
-                            meaning = data[0]["meanings"][0]["definitions"][0]["definition"]
-                            return f"The definition of '{term}' is: {meaning}"
-                        else:
-                            return f"Sorry, I couldn't find a definition for '{term}'."
-            except:
-                return "Sorry, I couldn't fetch the dictionary meaning right now."
-        return "Please tell me which word you'd like me to define."
-    if (skill == "time") or ("time" in user_text.lower()) or ("date" in user_text.lower()):
-        from datetime import datetime
-        now = datetime.now().strftime("%A, %d %B %Y, %H:%M:%S")
-        return f"The current date and time is {now}."
+                    meaning = data[0]["meanings"][0]["definitions"][0]["definition"]
+                    return f"The definition of '{term}' is: {meaning}"
+                else:
+                    return f"Sorry, I couldn't find a definition for '{term}'."
+        except:
+            return "Sorry, I couldn't fetch the dictionary meaning right now."
+    return "Please tell me which word you'd like me to define."
+
+
+async def _time_skill(user_text: str) -> Optional[str]:
+    now = datetime.now().strftime("%A, %d %B %Y, %H:%M:%S")
+    return f"The current date and time is {now}."
+
+
+# Checked in this order when a transcript mentions several skills.
+SKILLS = {
+    "weather": _weather_skill,
+    "news": _news_skill,
+    "joke": _joke_skill,
+    "quote": _quote_skill,
+    "dictionary": _dictionary_skill,
+    "time": _time_skill,
+}
+_SKILL_KEYWORDS = {
+    "weather": "weather",
+    "news": "news",
+    "joke": "joke", "jokes": "joke",
+    "quote": "quote", "quotes": "quote",
+    "define": "dictionary",
+    "time": "time", "date": "time",
+}
+_SKILL_RE = re.compile(r"\b(" + "|".join(map(re.escape, _SKILL_KEYWORDS)) + r")\b", re.IGNORECASE)
+
+
+async def handle_skill(user_text: str, forced_skill: Optional[str] = None) -> Optional[str]:
+    skill = _SKILL_KEYWORDS.get(forced_skill, forced_skill)
+    # One scan of the transcript finds every skill keyword it mentions.
+    mentioned = {_SKILL_KEYWORDS[m.group(1).lower()] for m in _SKILL_RE.finditer(user_text)}
+    for name, run in SKILLS.items():
+        if name == skill or name in mentioned:
+            reply = await run(user_text)
+            if reply:
+                return reply
     return None
 
 
 # ========= Murf Streaming =========
-async def stream_text_via_murf_and_forward(text: str, client_ws: WebSocket, session_id: str):
+# Text is pushed to Murf sentence by sentence as Gemini produces it. The first
+# flush is kept short so audio starts early; later flushes can be larger.
+MURF_FIRST_FLUSH_CHARS = 300
+MURF_MAX_FLUSH_CHARS = 4000
+_SENTENCE_END = re.compile(r"[.!?](?=\s)")
+
+
+def _split_speakable(buffer: str, limit: int):
+    """Split buffer into (ready, rest) at the last sentence end within limit.
+
+    If no sentence has ended but the buffer already exceeds limit, cut at the
+    last space so Murf is never starved by one very long sentence.
+    """
+    cut = 0
+    for m in _SENTENCE_END.finditer(buffer):
+        if m.end() > limit:
+            break
+        cut = m.end()
+    if not cut and len(buffer) > limit:
+        cut = buffer.rfind(" ", 0, limit) + 1 or limit
+    return buffer[:cut].strip(), buffer[cut:]
+
+
+MURF_WS_URI = (
+    f"wss://api.murf.ai/v1/speech/stream-input"
+    f"?api-key={ENV_MURF_API_KEY}&sample_rate=44100&channel_type=MONO&format=WAV"
+)
+
+# One Murf socket per /ws connection, opened when the connection starts. Each
+# assistant turn is its own Murf context, so no handshake is paid per turn.
+# Keyed by a per-connection id, not the client's session_id: a Stop/Start in
+# the same tab reuses the session_id while the old connection is still closing.
+connection_murf_ws: Dict[str, "asyncio.Task[ClientConnection]"] = {}
+
+
+async def _open_murf_ws() -> ClientConnection:
+    # Murf frames are mostly base64 audio, which deflate barely shrinks, so
+    # skip compression and allow a deeper receive queue for audio bursts.
+    murf_ws = await websockets.connect(
+        MURF_WS_URI,
+        ping_interval=20,
+        ping_timeout=30,
+        compression=None,
+        max_size=16 * 1024 * 1024,
+        max_queue=64,
+        write_limit=2 ** 20,
+    )
+    try:
+        await murf_ws.send(orjson.dumps({
+            "voice_config": {
+                "voiceId": FIXED_MURF_VOICE,
+                "style": "Conversational",
+                "rate": 0,
+                "pitch": 0,
+                "variation": 1
+            }
+        }).decode())
+    except BaseException:
+        await murf_ws.close()
+        raise
+    return murf_ws
+
+
+def open_murf_ws(conn_id: str):
+    """Start connecting to Murf in the background so the first turn finds it ready."""
+    connection_murf_ws[conn_id] = asyncio.create_task(_open_murf_ws())
+
+
+async def _murf_ws_for(conn_id: str) -> ClientConnection:
+    task = connection_murf_ws.get(conn_id)
+    if task is not None:
+        try:
+            murf_ws = await asyncio.shield(task)
+            if murf_ws.state is State.OPEN:
+                return murf_ws
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            pass
+    # Never opened, failed to open, or dropped by Murf since the last turn.
+    task = connection_murf_ws[conn_id] = asyncio.create_task(_open_murf_ws())
+    return await asyncio.shield(task)
+
+
+async def close_murf_ws(conn_id: str):
+    task = connection_murf_ws.pop(conn_id, None)
+    if task is None:
+        return
+    if not task.done():
+        task.cancel()
+        return
+    if task.cancelled() or task.exception() is not None:
+        return
+    try:
+        await task.result().close()
+    except:
+        pass
+
+
+async def _clear_murf_context(murf_ws: ClientConnection, context_id: str):
+    try:
+        await murf_ws.send(orjson.dumps({"context_id": context_id, "clear": True}).decode())
+    except:
+        pass
+
+
+async def _drain_chunks(chunks: AsyncIterable[str]):
+    """Consume the rest of a reply so its producer completes even when no audio is made."""
+    try:
+        async for _ in chunks:
+            pass
+    except Exception:
+        logger.exception("Failed to finish reply text")
+
+
+async def _single_chunk(text: str):
+    yield text
+
+
+async def stream_text_via_murf_and_forward(text: str, client_ws: WebSocket, session_id: str, conn_id: str):
+    await stream_chunks_via_murf_and_forward(_single_chunk(text), client_ws, session_id, conn_id)
+
+
+async def stream_chunks_via_murf_and_forward(
+    chunks: AsyncIterable[str], client_ws: WebSocket, session_id: str, conn_id: str
+):
     if not ENV_MURF_API_KEY:
+        await _drain_chunks(chunks)
         await safe_send_json(client_ws, {"event": "tts_skipped", "reason": "no_murf_key"})
         return
-    voice_id = FIXED_MURF_VOICE
 
-    uri = (
-        f"wss://api.murf.ai/v1/speech/stream-input"
-        f"?api-key={ENV_MURF_API_KEY}&sample_rate=44100&channel_type=MONO&format=WAV"
-    )
+    context_id = uuid.uuid4().hex
+    murf_ws = None
     try:
-        async with websockets.connect(uri, ping_interval=20, ping_timeout=30) as murf_ws:
-            await murf_ws.send(json.dumps({
-                "voice_config": {
-                    "voiceId": voice_id,
-                    "style": "Conversational",
-                    "rate": 0,
-                    "pitch": 0,
-                    "variation": 1
-                }
-            }))
-            await safe_send_json(client_ws, {"event": "tts_begin", "format": "wav", "sample_rate": 44100})
-            await murf_ws.send(json.dumps({"text": text, "end": True}))
-
+        murf_ws = await _murf_ws_for(conn_id)
+        await safe_send_json(client_ws, {
+            "event": "tts_begin", "context_id": context_id, "format": "wav", "sample_rate": 44100
+        })
+
+        async def send_text() -> bool:
+            buffer = ""
+            spoken = False
+            async for part in chunks:
+                buffer += part
+                limit = MURF_MAX_FLUSH_CHARS if spoken else MURF_FIRST_FLUSH_CHARS
+                ready, buffer = _split_speakable(buffer, limit)
+                if ready:
+                    await murf_ws.send(orjson.dumps({"text": ready, "end": False, "context_id": context_id}).decode())
+                    spoken = True
+            tail = buffer.strip()
+            if not spoken and not tail:
+                return False
+            await murf_ws.send(orjson.dumps({"text": tail, "end": True, "context_id": context_id}).decode())
+            return True
+
+        async def forward_audio():
             chunk_index = 0
             async for raw_msg in murf_ws:
                 try:
-                    if isinstance(raw_msg, bytes):
-                        raw_msg = raw_msg.decode("utf-8", errors="ignore")
-                    data = json.loads(raw_msg)
+                    data = orjson.loads(raw_msg)
                 except:
                     continue
+                # Late audio from an earlier, interrupted context is dropped.
+                if data.get("context_id") not in (None, context_id):
+                    continue
 
                 audio_b64 = data.get("audio") or (data.get("data") or {}).get("audio")
                 if audio_b64:
                     chunk_index += 1
-                    await safe_send_json(client_ws, {
-                        "event": "tts_chunk",
-                        "chunk_index": chunk_index,
-                        "audio_b64": audio_b64,
-                        "format": "wav",
-                        "sample_rate": 44100
-                    })
+                    audio = pybase64.b64decode(audio_b64, validate=False)
+                    header = TTS_CHUNK_HEADER.pack(MSG_TTS_CHUNK, FORMAT_WAV, chunk_index, 44100, len(audio))
+                    await safe_send_bytes(client_ws, header + audio)
                 if data.get("final") or data.get("type") in ("end", "session_end", "completed"):
                     break
+
+        receiver = asyncio.create_task(forward_audio())
+        try:
+            if await send_text():
+                await receiver
+        finally:
+            if not receiver.done():
+                # Wait it out so the next turn is the socket's only reader.
+                receiver.cancel()
+                await asyncio.wait([receiver])
+    except asyncio.CancelledError:
+        if murf_ws is not None:
+            await _clear_murf_context(murf_ws, context_id)
+        raise
     except Exception as e:
         logger.exception("Murf streaming error for session %s: %s", session_id, e)
+        await close_murf_ws(conn_id)
         await safe_send_json(client_ws, {"event": "tts_error", "error": str(e)})
+        # Let the text side of the turn finish (turn_end, save_turn) without audio.
+        await _drain_chunks(chunks)
     finally:
         await safe_send_json(client_ws, {"event": "tts_done"})
 
 
 # ========= Gemini =========
-def generate_gemini_text(prompt: str) -> str:
-    if not ENV_GEMINI_API_KEY:
-        return ""
+_STREAM_DONE = object()
+
+# Replies keyed by (persona, normalized prompt). Prompts carry no history, so
+# repeated small talk ("hi", "tell me something fun") can skip Gemini.
+GEMINI_REPLY_CACHE_SIZE = 2048
+gemini_reply_cache: LRUCache = LRUCache(maxsize=GEMINI_REPLY_CACHE_SIZE)
+
+
+def _reply_cache_key(persona: str, prompt: str):
+    return persona, _normalize_text(prompt)
+
+
+# One ready-made model per persona, built once at import rather than per turn.
+GEMINI_MODELS = {
+    name: genai.GenerativeModel("gemini-2.5-flash", system_instruction=system_prompt)
+    for name, system_prompt in PERSONA_SYSTEM_PROMPTS.items()
+} if ENV_GEMINI_API_KEY else {}
+
+
+async def generate_gemini_text_stream(prompt: str, persona: str) -> AsyncIterator[str]:
+    model = GEMINI_MODELS.get(persona)
+    if model is None:
+        return
+    # The SDK stream is a blocking iterator; pull each part in a thread so
+    # the event loop keeps serving audio and other sessions meanwhile.
+    resp = await asyncio.to_thread(model.generate_content, prompt, stream=True)
+    parts = iter(resp)
+    while True:
+        part = await asyncio.to_thread(next, parts, _STREAM_DONE)
+        if part is _STREAM_DONE:
+            break
+        try:
+            txt = part.text
+        except:
+            txt = ""
+        if txt:
+            yield txt
+
+
+async def gemini_turn_to_murf(prompt: str, client_ws: WebSocket, session_id: str, conn_id: str):
     try:
-        genai.configure(api_key=ENV_GEMINI_API_KEY)
-        model = genai.GenerativeModel("gemini-2.5-flash")
-        resp = model.generate_content(prompt)
-        txt = getattr(resp, "text", None)
-        if not txt:
-            try:
-                txt = resp.candidates[0].content.parts[0].text
-            except:
-                txt = ""
-        return (txt or "").strip()
-    except Exception as e:
-        logger.exception("Gemini generation failed: %s", e)
-        return ""
+        await _run_assistant_turn(prompt, client_ws, session_id, conn_id)
+    except asyncio.CancelledError:
+        # The user spoke over this reply; the client drops any queued audio.
+        await safe_send_json(client_ws, {"event": "tts_interrupted"})
+        raise
 
 
-async def gemini_turn_to_murf(prompt: str, client_ws: WebSocket, session_id: str):
+async def _run_assistant_turn(prompt: str, client_ws: WebSocket, session_id: str, conn_id: str):
     forced_skill = session_skills.get(session_id, "none")
     skill_reply = await handle_skill(prompt, None if forced_skill == "none" else forced_skill)
     if skill_reply:
         await save_turn(session_id, "assistant", skill_reply)
         await safe_send_json(client_ws, {"event": "turn_end", "role": "assistant", "text": skill_reply})
-        await stream_text_via_murf_and_forward(skill_reply, client_ws, session_id)
+        await stream_text_via_murf_and_forward(skill_reply, client_ws, session_id, conn_id)
         return
 
+    # The persona is already the model's system instruction; only the
+    # user's words are sent per turn.
     persona = session_personas.get(session_id, "default")
-    system_prompt = PERSONA_PROMPTS.get(persona, PERSONA_PROMPTS["default"])
-    full_prompt = f"{system_prompt}\nUser said: {prompt}\nRespond in character."
 
-    text_to_speak = generate_gemini_text(full_prompt)
-    if text_to_speak:
-        await save_turn(session_id, "assistant", text_to_speak)
-        await safe_send_json(client_ws, {"event": "turn_end", "role": "assistant", "text": text_to_speak})
-        await stream_text_via_murf_and_forward(text_to_speak, client_ws, session_id)
+    cache_key = _reply_cache_key(persona, prompt)
+    cached_reply = gemini_reply_cache.get(cache_key)
+    if cached_reply:
+        await save_turn(session_id, "assistant", cached_reply)
+        await safe_send_json(client_ws, {"event": "turn_end", "role": "assistant", "text": cached_reply})
+        await stream_text_via_murf_and_forward(cached_reply, client_ws, session_id, conn_id)
+        return
+
+    async def reply_chunks():
+        parts = []
+        complete = True
+        try:
+            async for part in generate_gemini_text_stream(prompt, persona):
+                parts.append(part)
+                yield part
+        except Exception as e:
+            complete = False
+            logger.exception("Gemini generation failed: %s", e)
+        text_to_speak = "".join(parts).strip()
+        if text_to_speak:
+            if complete:
+                gemini_reply_cache[cache_key] = text_to_speak
+            await save_turn(session_id, "assistant", text_to_speak)
+            await safe_send_json(client_ws, {"event": "turn_end", "role": "assistant", "text": text_to_speak})
+
+    await stream_chunks_via_murf_and_forward(reply_chunks(), client_ws, session_id, conn_id)
 
 
 # ========= WebSocket Endpoint =========
@@ -259,39 +630,37 @@ async def gemini_turn_to_murf(prompt: str, client_ws: WebSocket, session_id: str
 async def ws_endpoint(ws: WebSocket):
     await ws.accept()
     qp = ws.query_params
-    session_id = qp.get("session_id") or str(id(ws))
+    conn_id = uuid.uuid4().hex
+    session_id = qp.get("session_id") or conn_id
     persona = qp.get("persona") or "default"
+    if persona not in PERSONA_PROMPTS:
+        persona = "default"
     skill = qp.get("skill") or "none"
 
     session_personas[session_id] = persona
     session_skills[session_id] = skill
-    session_inflight[session_id] = False
-    session_last_text[session_id] = ""
+    session_last_text[session_id] = None
 
     if not ENV_ASSEMBLYAI_KEY:
         await safe_send_json(ws, {"event": "error", "error": "AssemblyAI key not provided."})
         await ws.close()
         return
 
-    async with history_lock:
-        if session_id not in session_histories:
-            session_histories[session_id] = []
+    if session_id not in session_histories:
+        session_histories[session_id] = deque(maxlen=HISTORY_TURNS_KEPT)
 
-    turn_queue: asyncio.Queue[Optional[str]] = asyncio.Queue()
+    if ENV_MURF_API_KEY:
+        open_murf_ws(conn_id)
 
-    async def tts_worker():
-        while True:
-            text = await turn_queue.get()
-            if text is None:
-                turn_queue.task_done()
-                break
-            try:
-                await gemini_turn_to_murf(text, ws, session_id)
-            finally:
-                session_inflight[session_id] = False
-                turn_queue.task_done()
+    # The assistant reply in progress, if any. A new user turn cancels it
+    # (barge-in) instead of being dropped while the stale reply plays out.
+    turn_task: Optional[asyncio.Task] = None
+    last_turn_order = None
 
-    worker_task = asyncio.create_task(tts_worker())
+    async def interrupt_turn():
+        if turn_task is not None and not turn_task.done():
+            turn_task.cancel()
+            await asyncio.wait([turn_task])
 
     params = {
         "sample_rate": "16000",
@@ -313,7 +682,9 @@ async def ws_endpoint(ws: WebSocket):
             additional_headers=headers,
             ping_interval=15,
             ping_timeout=30,
-            max_size=8 * 1024 * 1024
+            max_size=8 * 1024 * 1024,
+            compression="deflate",  # AssemblyAI replies are small JSON frames
+            write_limit=2 ** 20,
         ) as aai_ws:
 
             async def upstream():
@@ -335,11 +706,10 @@ async def ws_endpoint(ws: WebSocket):
                     pass
 
             async def downstream():
+                nonlocal turn_task, last_turn_order
                 async for raw_msg in aai_ws:
                     try:
-                        if isinstance(raw_msg, bytes):
-                            raw_msg = raw_msg.decode("utf-8", errors="ignore")
-                        evt = json.loads(raw_msg)
+                        evt = orjson.loads(raw_msg)
                     except:
                         continue
 
@@ -352,29 +722,28 @@ async def ws_endpoint(ws: WebSocket):
                             transcript_str = transcript.strip()
                             if not transcript_str:
                                 continue
-                            norm = " ".join(transcript_str.split()).casefold()
-                            if session_inflight.get(session_id, False):
+                            # With format_turns, AssemblyAI ends each turn twice
+                            # (raw, then formatted) under the same turn_order.
+                            turn_order = evt.get("turn_order")
+                            if turn_order is not None and turn_order == last_turn_order:
                                 continue
-                            if norm == session_last_text.get(session_id, ""):
+                            norm_hash = hash(_normalize_text(transcript_str))
+                            if norm_hash == session_last_text.get(session_id):
                                 continue
-                            session_last_text[session_id] = norm
-                            session_inflight[session_id] = True
+                            last_turn_order = turn_order
+                            session_last_text[session_id] = norm_hash
+                            await interrupt_turn()
                             await save_turn(session_id, "user", transcript_str)
                             await safe_send_json(ws, {"event": "turn_end", "role": "user", "text": transcript_str})
-                            await turn_queue.put(transcript_str)
+                            turn_task = asyncio.create_task(gemini_turn_to_murf(transcript_str, ws, session_id, conn_id))
                     elif t in ("Termination", "TerminateSession"):
                         break
 
             await asyncio.gather(upstream(), downstream())
     finally:
-        await turn_queue.put(None)
-        worker_task.cancel()
-        try:
-            await worker_task
-        except:
-            pass
-        for d in [session_personas, session_skills, session_inflight, session_last_text]:
-            d.pop(session_id, None)
+        await interrupt_turn()
+        await close_murf_ws(conn_id)
+        _drop_session_state(session_id)
         try:
             await ws.close()
         except:
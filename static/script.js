@@ -6,6 +6,7 @@ document.addEventListener("DOMContentLoaded", () => {
   let mediaStream = null;
 
   let playQueue = [];
+  let scheduledSources = [];
   let playheadTime = 0;
   let wavHeaderSeen = false;
   let userBubble = null;
@@ -13,6 +14,11 @@ document.addEventListener("DOMContentLoaded", () => {
   const OUTPUT_RATE = 44100;
   const AAI_SEND_RATE = 16000;
 
+  // Binary TTS frames: big-endian u16 type, u16 format, u32 chunk index,
+  // u32 sample rate, u32 payload length, then the raw audio bytes.
+  const TTS_HEADER_BYTES = 16;
+  const MSG_TTS_CHUNK = 1;
+
   // --- DOM Elements ---
   const chatBox = document.getElementById("chatBox");
   const startBtn = document.getElementById("startBtn");
@@ -53,17 +59,6 @@ document.addEventListener("DOMContentLoaded", () => {
     return buffer;
   }
 
-  function base64ToUint8Array(b64) {
-    try {
-      const bin = atob(b64);
-      const out = new Uint8Array(bin.length);
-      for (let i = 0; i < bin.length; i++) out[i] = bin.charCodeAt(i);
-      return out;
-    } catch {
-      return new Uint8Array(0);
-    }
-  }
-
   // --- UI ---
   function addMessage(role, text) {
     if (!text) return;
@@ -88,8 +83,7 @@ document.addEventListener("DOMContentLoaded", () => {
   }
   function updateUserBubble(text) { if (userBubble) userBubble.textContent = text; }
 
-  function wavChunkToFloat32(b64) {
-    const bytes = base64ToUint8Array(b64);
+  function wavChunkToFloat32(bytes) {
     if (!bytes.length) return new Float32Array(0);
     let pcmU8;
     if (!wavHeaderSeen && bytes.length >= 44) {
@@ -103,6 +97,15 @@ document.addEventListener("DOMContentLoaded", () => {
     return f32;
   }
 
+  function handleBinaryFrame(buf) {
+    if (buf.byteLength < TTS_HEADER_BYTES) return;
+    const view = new DataView(buf);
+    if (view.getUint16(0) !== MSG_TTS_CHUNK) return;
+    const len = Math.min(view.getUint32(12), buf.byteLength - TTS_HEADER_BYTES);
+    const f32 = wavChunkToFloat32(new Uint8Array(buf, TTS_HEADER_BYTES, len));
+    if (f32.length) { playQueue.push(f32); schedulePlayback(); }
+  }
+
   function schedulePlayback() {
     if (!audioContext) return;
     if (audioContext.state === "suspended") audioContext.resume();
@@ -114,12 +117,22 @@ document.addEventListener("DOMContentLoaded", () => {
       buf.copyToChannel(chunk, 0);
       const src = audioContext.createBufferSource();
       src.buffer = buf; src.connect(audioContext.destination);
+      src.onended = () => { scheduledSources = scheduledSources.filter((s) => s !== src); };
+      scheduledSources.push(src);
       if (playheadTime < now + LOOKAHEAD) playheadTime = now + LOOKAHEAD;
       src.start(playheadTime);
       playheadTime += chunk.length / OUTPUT_RATE;
     }
   }
 
+  // Barge-in: silence whatever is still queued from the previous reply. The
+  // server may have finished streaming it long before playback ends.
+  function stopPlayback() {
+    scheduledSources.forEach((src) => { try { src.stop(); } catch {} });
+    scheduledSources = []; playQueue = [];
+    if (audioContext) playheadTime = audioContext.currentTime;
+  }
+
   async function startSession() {
     playQueue = []; wavHeaderSeen = false; playheadTime = 0; userBubble = null;
     audioContext = new (window.AudioContext || window.webkitAudioContext)({ sampleRate: OUTPUT_RATE });
@@ -140,6 +153,7 @@ document.addEventListener("DOMContentLoaded", () => {
     let lastAssistant = "";
 
     ws.onmessage = async (evt) => {
+      if (evt.data instanceof ArrayBuffer) { handleBinaryFrame(evt.data); return; }
       if (typeof evt.data !== "string") return;
       try {
         const msg = JSON.parse(evt.data);
@@ -153,9 +167,9 @@ document.addEventListener("DOMContentLoaded", () => {
         }
         switch (msg.event) {
           case "turn_end": updateUserBubble(msg.text || ""); break;
-          case "tts_begin": playQueue = []; wavHeaderSeen = false; playheadTime = audioContext.currentTime + 0.05; break;
-          case "tts_chunk": { const f32 = wavChunkToFloat32(msg.audio_b64 || ""); if (f32.length) { playQueue.push(f32); schedulePlayback(); } break; }
+          case "tts_begin": stopPlayback(); wavHeaderSeen = false; playheadTime = audioContext.currentTime + 0.05; break;
           case "tts_done": audioEl.play().catch(() => {}); break;
+          case "tts_interrupted": stopPlayback(); break;
         }
       } catch (e) { console.warn("WS parse error", e); }
     };